@@ -1,11 +1,15 @@
+import csv
+import io
 import logging
 import os
 import pickle
 import traceback
-from dataclasses import dataclass
-from time import sleep
-from typing import Optional, List, Callable
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from time import monotonic, sleep
+from typing import Optional, List, Callable, Union
 
+import psycopg2
 from arrow import Arrow
 from pytimeparse import parse as parse_seconds
 from sqlalchemy import (
@@ -17,9 +21,12 @@ from sqlalchemy import (
     TIMESTAMP,
     INTEGER,
     desc,
+    inspect,
+    select,
 )
-from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.engine import Engine, Connection, make_url
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects import postgresql, sqlite
 from withings_api import Credentials2, WithingsApi, MeasureGetMeasResponse, WithingsAuth
 from withings_api.common import (
     MeasureGetMeasGroup,
@@ -28,21 +35,49 @@ from withings_api.common import (
     AuthScope,
 )
 
+# Batch sizes above which psycopg2 inserts switch to unnest, then to COPY
+UNNEST_INSERT_THRESHOLD = 50
+COPY_INSERT_THRESHOLD = 200
+RECONCILE_SECONDS = 60 * 60
+# Prefix of credentials pickled by older versions
+PICKLE_MARKER = b"\x80"
+CREDENTIALS_ROW_ID = 1
 
-@dataclass(frozen=True)
+# Dialect-specific inserts, the only ones with on_conflict_do_nothing / on_conflict_do_update
+UpsertInsert = Union[postgresql.Insert, sqlite.Insert]
+
+
+@dataclass(frozen=True, slots=True)
 class Config:
     client_id: str
     secret: str
     conn_string: str
-    refresh_seconds: int
+    refresh_seconds: float
 
     @staticmethod
     def parse(env=os.environ):
+        return Config._parse(
+            env["WITHINGS_CLIENT_ID"],
+            env["WITHINGS_SECRET"],
+            env["SQLALCHEMY_CONN_STRING"],
+            env["REFRESH_PERIOD"],
+        )
+
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def _parse(client_id: str, secret: str, conn_string: str, refresh_period: str) -> "Config":
+        """Cached on the raw values, since os.environ itself isn't hashable"""
+        refresh_seconds = parse_seconds(refresh_period)
+        # pytimeparse returns None for anything it can't read, even "300"
+        if refresh_seconds is None or refresh_seconds <= 0:
+            raise ValueError(
+                f"REFRESH_PERIOD must be a positive duration like '5 minutes', got {refresh_period!r}"
+            )
         return Config(
-            client_id=env["WITHINGS_CLIENT_ID"],
-            secret=env["WITHINGS_SECRET"],
-            conn_string=env["SQLALCHEMY_CONN_STRING"],
-            refresh_seconds=parse_seconds(env["REFRESH_PERIOD"]),
+            client_id=client_id,
+            secret=secret,
+            conn_string=conn_string,
+            refresh_seconds=refresh_seconds,
         )
 
 
@@ -52,9 +87,21 @@ class Database:
     meta: MetaData
     credentials: Table
     weight: Table
+    insert: Callable[[Table], UpsertInsert]
 
 
-@dataclass
+_FIELD_BY_TYPE = {
+    MeasureType.WEIGHT: "weight",
+    MeasureType.FAT_MASS_WEIGHT: "fat_mass",
+    MeasureType.MUSCLE_MASS: "muscle_mass",
+    MeasureType.HYDRATION: "hydration",
+    MeasureType.BONE_MASS: "bone_mass",
+    MeasureType.FAT_RATIO: "fat_ratio",
+    MeasureType.FAT_FREE_MASS: "fat_free_mass",
+}
+
+
+@dataclass(frozen=True, slots=True)
 class Weight:
     """Weight measures are in thousandths of a kg, others are in hundredths"""
 
@@ -69,8 +116,7 @@ class Weight:
 
     @staticmethod
     def from_measure(measure_group: MeasureGetMeasGroup) -> "Weight":
-        weight = Weight(
-            created_at=measure_group.created,
+        values = dict(
             weight=-1,
             fat_mass=None,
             muscle_mass=None,
@@ -81,41 +127,59 @@ class Weight:
         )
 
         for measure in measure_group.measures:
-            if measure.type == MeasureType.WEIGHT:
-                weight.weight = measure.value
-            elif measure.type == MeasureType.FAT_MASS_WEIGHT:
-                weight.fat_mass = measure.value
-            elif measure.type == MeasureType.MUSCLE_MASS:
-                weight.muscle_mass = measure.value
-            elif measure.type == MeasureType.HYDRATION:
-                weight.hydration = measure.value
-            elif measure.type == MeasureType.BONE_MASS:
-                weight.bone_mass = measure.value
-            elif measure.type == MeasureType.FAT_RATIO:
-                weight.fat_ratio = measure.value
-            elif measure.type == MeasureType.FAT_FREE_MASS:
-                weight.fat_free_mass = measure.value
-
-        if weight.weight < 0:
+            field = _FIELD_BY_TYPE.get(measure.type)
+            if field is not None:
+                values[field] = measure.value
+
+        if values["weight"] < 0:
             logging.error(f"Failed trying to parse measure, no WEIGHT: {measure_group}")
-        return weight
+        return Weight(created_at=measure_group.created, **values)
+
+    def as_row(self) -> tuple:
+        """Column values in WEIGHT_COLUMNS order, ready to bind"""
+        return (
+            self.created_at.datetime,
+            *(getattr(self, column) for column in WEIGHT_COLUMNS[1:]),
+        )
+
+
+# Weight fields double as the weight table's columns, created_at first
+WEIGHT_COLUMNS = tuple(field.name for field in fields(Weight))
 
 
 def measures_to_weights(measures: MeasureGetMeasResponse) -> List[Weight]:
-    weights = {}
-    for measure_group in measures.measuregrps:
-        weight = Weight.from_measure(measure_group)
-        weights[weight.created_at] = weight
-    return sorted(weights.values(), key=lambda w: w.created_at)
+    weights = [Weight.from_measure(group) for group in measures.measuregrps]
+    weights.sort(key=lambda w: w.created_at.int_timestamp)
+
+    deduped = []
+    for weight in weights:
+        if deduped and deduped[-1].created_at.int_timestamp == weight.created_at.int_timestamp:
+            deduped[-1] = weight
+        else:
+            deduped.append(weight)
+    return deduped
 
 
 def connect_to_database(config: Config) -> Database:
     logging.debug("Connecting to database")
-    engine = create_engine(config.conn_string)
+    engine_options = dict(future=True)
+    if make_url(config.conn_string).get_backend_name() != "sqlite":
+        engine_options.update(
+            pool_size=5,
+            max_overflow=5,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            pool_use_lifo=True,
+        )
+    engine = create_engine(config.conn_string, **engine_options)
+    insert = dialect_insert(engine)
     meta = MetaData()
 
     credentials = Table(
-        "credentials", meta, Column("credentials_pkl", LargeBinary, nullable=False)
+        "credentials",
+        meta,
+        Column("id", INTEGER, primary_key=True, autoincrement=False, default=CREDENTIALS_ROW_ID),
+        Column("credentials_pkl", LargeBinary, nullable=False),
     )
 
     weight = Table(
@@ -131,19 +195,67 @@ def connect_to_database(config: Config) -> Database:
         Column("fat_free_mass", INTEGER),
     )
 
+    if inspect(engine).has_table("credentials"):
+        migrate_credentials_table(engine, credentials)
     meta.create_all(engine)
-    return Database(engine, meta, credentials, weight)
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            storage = conn.exec_driver_sql(
+                "SELECT attstorage FROM pg_attribute "
+                "WHERE attrelid = 'credentials'::regclass AND attname = 'credentials_pkl'"
+            ).scalar()
+            # Checked first, since the ALTER takes an ACCESS EXCLUSIVE lock on every run
+            if storage != "p":
+                conn.exec_driver_sql(
+                    "ALTER TABLE credentials ALTER COLUMN credentials_pkl SET STORAGE PLAIN"
+                )
+        # Only enables index-only scans, so a failure shouldn't stop startup
+        try:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.exec_driver_sql("VACUUM (ANALYZE) weight")
+        except SQLAlchemyError:
+            logging.warning("Failed to vacuum the weight table, continuing without it")
+            traceback.print_exc()
+    return Database(engine, meta, credentials, weight, insert)
+
+
+def migrate_credentials_table(engine: Engine, credentials: Table):
+    """Rebuilds a credentials table created before it had an id column, keeping the saved credentials"""
+    columns = {column["name"] for column in inspect(engine).get_columns("credentials")}
+    if "id" in columns:
+        return
+
+    logging.info("Adding id column to credentials table")
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            # pysqlite only opens a transaction before DML, which would leave the DROP unprotected
+            conn.exec_driver_sql("BEGIN")
+        blob = conn.exec_driver_sql("SELECT credentials_pkl FROM credentials").scalar()
+        conn.exec_driver_sql("DROP TABLE credentials")
+        credentials.create(conn)
+        if blob is not None:
+            conn.execute(credentials.insert().values(credentials_pkl=blob))
+
+
+def dialect_insert(engine: Engine) -> Callable[[Table], UpsertInsert]:
+    """Returns the insert construct for the engine's dialect, which carries its ON CONFLICT support"""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert
+    if engine.dialect.name == "sqlite":
+        return sqlite.insert
+    raise ValueError(
+        f"Unsupported database backend {engine.dialect.name!r}: weights and credentials are "
+        "upserted with ON CONFLICT, which is only supported here for postgresql and sqlite"
+    )
 
 
 def ensure_credentials(conf: Config, database: Database) -> Credentials2:
     """Fetches credentials from the db, and runs oauth flow if they can't be used or found"""
     logging.debug("Attempting to fetch credentials from the database")
-    conn = database.engine.connect()
-
-    existing_creds = get_credentials(database, conn)
+    existing_creds = get_credentials(database)
     if existing_creds:
         try:
-            WithingsApi(existing_creds).measure_get_meas()
+            WithingsApi(existing_creds).user_get_device()
             return existing_creds
         except AuthFailedException:
             logging.warning("Withings authorization failed, attempting to refresh...")
@@ -168,33 +280,48 @@ Go to the following URL, click the link, and paste the resulting `code` paramete
 """)
     code = input("URL Code:")
     creds = auth.get_credentials(code)
-    save_credentials(database, conn, creds)
+    with database.engine.begin() as conn:
+        save_credentials(database, conn, creds)
     return creds
 
 
 def get_credentials(
-        database: Database, conn: Optional[Connection]
+        database: Database, conn: Optional[Connection] = None
 ) -> Optional[Credentials2]:
     if conn is None:
-        conn = database.engine.connect()
+        with database.engine.connect() as conn:
+            return get_credentials(database, conn)
 
     last_cred = conn.execute(database.credentials.select()).first()
 
-    if last_cred is not None:
-        return deseralize_credentials(last_cred["credentials_pkl"])
+    if last_cred is None:
+        return None
+
+    creds = deseralize_credentials(last_cred.credentials_pkl)
+    if last_cred.credentials_pkl.startswith(PICKLE_MARKER):
+        logging.info("Rewriting pickled credentials as JSON")
+        with database.engine.begin() as write_conn:
+            save_credentials(database, write_conn, creds)
+    return creds
 
 
 def save_credentials(database: Database, conn: Connection, creds: Credentials2):
-    conn.execute(database.credentials.delete())
-    conn.execute(database.credentials.insert().values(credentials_pkl=serialize_credentials(creds)))
+    insert_stmt = database.insert(database.credentials).values(
+        id=CREDENTIALS_ROW_ID, credentials_pkl=serialize_credentials(creds)
+    )
+    conn.execute(
+        insert_stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_=dict(credentials_pkl=insert_stmt.excluded.credentials_pkl),
+        )
+    )
 
 
 def build_token_refresh_callback(database: Database) -> Callable[[Credentials2], None]:
-    conn = database.engine.connect()
-
     def refresh_callback(creds: Credentials2):
         """Saves credentials when they are refreshed"""
-        save_credentials(database, conn, creds)
+        with database.engine.begin() as conn:
+            save_credentials(database, conn, creds)
 
     return refresh_callback
 
@@ -204,17 +331,19 @@ def monitor_weight(conf: Config, database: Database, creds: Credentials2):
     logging.debug("Creating auth from credentials")
     refresh_cb = build_token_refresh_callback(database)
     withings = WithingsApi(creds, refresh_cb=refresh_cb)
-    if conf.conn_string.startswith('postgresql'):
-        from sqlalchemy.dialects.postgresql import insert
-    elif 'sqlite' in conf.conn_string:
-        from sqlalchemy.dialects.sqlite import insert
-    else:
-        from sqlalchemy import insert
+    is_psycopg2 = database.engine.driver == "psycopg2"
+    insert_stmt = database.insert(database.weight).on_conflict_do_nothing(
+        index_elements=["created_at"]
+    )
 
+    last_weight_timestamp = None
+    reconciled_at = None
     while True:
-        start_time = Arrow.now()
-        conn = database.engine.connect()
-        last_weight_timestamp = get_last_weight_timestamp(conn, database)
+        start_time = monotonic()
+        if reconciled_at is None or start_time - reconciled_at >= RECONCILE_SECONDS:
+            with database.engine.connect() as conn:
+                last_weight_timestamp = get_last_weight_timestamp(conn, database)
+            reconciled_at = start_time
         logging.info(f"Pulling weights since {last_weight_timestamp}")
         measures = withings.measure_get_meas(
             startdate=last_weight_timestamp, lastupdate=None
@@ -223,52 +352,93 @@ def monitor_weight(conf: Config, database: Database, creds: Credentials2):
 
         logging.info(f"Found {len(weights)} new weights")
 
-        with conn.begin():
+        if not weights:
+            logging.debug("No new weights, skipping database write")
+        else:
             try:
-                data = [
-                    dict(
-                        created_at=weight.created_at.datetime,
-                        weight=weight.weight,
-                        fat_mass=weight.fat_mass,
-                        muscle_mass=weight.muscle_mass,
-                        hydration=weight.hydration,
-                        bone_mass=weight.bone_mass,
-                        fat_ratio=weight.fat_ratio,
-                        fat_free_mass=weight.fat_free_mass,
-                    )
-                    for weight in weights
-                ]
-                insert_stmt = insert(database.weight).values(data).on_conflict_do_nothing()
-                results = conn.execute(insert_stmt)
-                logging.info(f"Inserted {results.rowcount} rows")
-            except SQLAlchemyError:
+                with database.engine.begin() as conn:
+                    rows = [weight.as_row() for weight in weights]
+                    if is_psycopg2 and len(rows) > COPY_INSERT_THRESHOLD:
+                        rowcount = bulk_upsert_weights(conn, rows)
+                    elif is_psycopg2 and len(rows) > UNNEST_INSERT_THRESHOLD:
+                        rowcount = unnest_insert_weights(conn, rows)
+                    else:
+                        data = [dict(zip(WEIGHT_COLUMNS, row)) for row in rows]
+                        rowcount = conn.execute(insert_stmt, data).rowcount
+                    logging.info(f"Inserted {rowcount} rows")
+                # measures_to_weights sorts by timestamp, so the last weight is the newest
+                last_weight_timestamp = weights[-1].created_at
+            except (SQLAlchemyError, psycopg2.Error):
                 logging.error("Failed to write weight to database")
                 traceback.print_exc()
 
-        sleep_for = conf.refresh_seconds - (Arrow.now() - start_time).seconds
+        sleep_for = max(0.0, start_time + conf.refresh_seconds - monotonic())
         logging.debug(f"Sleeping for {sleep_for} seconds")
         sleep(sleep_for)
 
 
-def get_last_weight_timestamp(conn: Connection, database: Database) -> Optional[Arrow]:
-    weights = (
-        database.weight.select().order_by(desc(database.weight.c.created_at)).limit(1)
+def unnest_insert_weights(conn: Connection, rows: List[tuple]) -> int:
+    """Inserts rows as one array per column through unnest, in a single statement (psycopg2 only)"""
+    column_list = ", ".join(WEIGHT_COLUMNS)
+    arrays = ", ".join(["%s::timestamp[]"] + ["%s::integer[]"] * (len(WEIGHT_COLUMNS) - 1))
+    # psycopg2 adapts lists, not tuples, to postgres arrays
+    columns = [list(column) for column in zip(*rows)]
+
+    with conn.connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO weight ({column_list}) SELECT * FROM unnest({arrays}) "
+            "ON CONFLICT (created_at) DO NOTHING",
+            columns,
+        )
+        return cursor.rowcount
+
+
+def bulk_upsert_weights(conn: Connection, rows: List[tuple]) -> int:
+    """Streams rows into a temp table with COPY, then upserts them into weight (psycopg2 only)"""
+    column_list = ", ".join(WEIGHT_COLUMNS)
+    buf = io.StringIO()
+    # csv writes None as an unquoted empty field, which COPY reads back as NULL
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+
+    # timestamptz so created_at converts the same way as in the bound insert paths
+    stage_columns = ", ".join(
+        ["created_at timestamptz"] + [f"{column} integer" for column in WEIGHT_COLUMNS[1:]]
     )
-    last_weight = conn.execute(weights).first()
-    if last_weight is not None:
-        return Arrow.fromdatetime(last_weight.created_at)
+
+    with conn.connection.cursor() as cursor:
+        cursor.execute(f"CREATE TEMP TABLE weight_stage ({stage_columns}) ON COMMIT DROP")
+        cursor.copy_expert(
+            f"COPY weight_stage ({column_list}) FROM STDIN WITH (FORMAT CSV)", buf
+        )
+        cursor.execute(
+            f"INSERT INTO weight ({column_list}) SELECT {column_list} FROM weight_stage "
+            "ON CONFLICT (created_at) DO NOTHING"
+        )
+        return cursor.rowcount
+
+
+def get_last_weight_timestamp(conn: Connection, database: Database) -> Optional[Arrow]:
+    created_at = database.weight.c.created_at
+    last_created_at = conn.execute(
+        select(created_at).order_by(desc(created_at)).limit(1)
+    ).scalar()
+    if last_created_at is not None:
+        return Arrow.fromdatetime(last_created_at)
     else:
         return None
 
 
 def serialize_credentials(creds: Credentials2) -> bytes:
-    """Serializes credentials using pickle"""
-    return pickle.dumps(creds)
+    """Serializes credentials as JSON"""
+    return creds.json(encoder=Arrow.isoformat).encode()
 
 
 def deseralize_credentials(data: bytes) -> Credentials2:
-    """Unpickles credentials"""
-    return pickle.loads(data)
+    """Deserializes JSON credentials, or pickled ones written by older versions"""
+    if data.startswith(PICKLE_MARKER):
+        return pickle.loads(data)
+    return Credentials2.parse_raw(data)
 
 
 def main():